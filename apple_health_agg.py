@@ -0,0 +1,336 @@
+"""
+Shared helpers for reading and aggregating Apple Health export.xml files,
+and for writing the aggregated numbers to Excel or posting them as JSON.
+
+Exports are streamed with iterparse so only the element currently being
+processed is kept in memory. lxml is used when installed, otherwise the
+standard library ElementTree parser is used.
+"""
+
+import os
+import gzip
+import json
+import http.client
+import urllib.parse as urlparse
+from array import array
+from datetime import date
+from xml.sax.saxutils import quoteattr
+from openpyxl.cell import WriteOnlyCell
+
+try:
+    from lxml import etree as ET
+
+    HAVE_LXML = True
+    # Lift libxml2's size limits for multi-GB exports and skip the xml:id
+    # index, which Apple Health files do not use
+    ITERPARSE_OPTIONS = {"huge_tree": True, "collect_ids": False}
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    HAVE_LXML = False
+    ITERPARSE_OPTIONS = {}
+
+# JSON bodies larger than this are gzip-compressed before upload
+GZIP_MIN_BYTES = 4096
+# Errors from reusing a connection the server already closed
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+def iter_elements(path, tags=("Record",), nested=True):
+    """Yield the elements of `path` whose tag is in `tags`.
+
+    With nested=False only direct children of the root are yielded, so e.g.
+    Records inside a Correlation are skipped.
+
+    Each element is cleared once the caller advances the generator, so copy
+    anything that must outlive the loop body (e.g. dict(elem.attrib)).
+    """
+    tags = tuple(tags)
+    if HAVE_LXML:
+        context = ET.iterparse(path, events=("end",), tag=tags, **ITERPARSE_OPTIONS)
+        for _, elem in context:
+            if nested or elem.getparent().getparent() is None:
+                yield elem
+            elem.clear()
+            # Drop already processed siblings so the tree never grows
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if elem.tag in tags and (nested or depth == 0):
+            yield elem
+        if depth == 0:
+            # A top-level child just ended: nothing below the root is needed
+            root.clear()
+
+
+def write_without(path, output_path, drop=("Record", "ActivitySummary")):
+    """Stream `path` to `output_path`, leaving out every element in `drop`.
+
+    Top-level children are written one at a time, indented like ET.indent,
+    so the source tree is never held in memory. The output goes to a
+    temporary file first, which also makes `output_path == path` safe; it is
+    removed again if parsing or writing fails.
+    """
+    drop = tuple(drop)
+    tmp_path = f"{output_path}.tmp"
+    context = ET.iterparse(path, events=("start", "end"), **ITERPARSE_OPTIONS)
+    _, root = next(context)
+    attrs = "".join(f" {k}={quoteattr(v)}" for k, v in root.attrib.items())
+    depth = 0
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            out.write(f"<{root.tag}{attrs}>")
+            for event, elem in context:
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth:
+                    continue
+                if elem.tag not in drop:
+                    # Dropped tags nested deeper, e.g. Records inside a Correlation
+                    nested = [(p, c) for p in elem.iter() for c in p if c.tag in drop]
+                    for parent, child in nested:
+                        parent.remove(child)
+                        if not len(parent) and not (parent.text or "").strip():
+                            parent.text = None
+                    elem.tail = None
+                    ET.indent(elem, space="  ", level=1)
+                    out.write("\n  " + ET.tostring(elem, encoding="unicode"))
+                root.clear()
+            out.write(f"\n</{root.tag}>")
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        # Parse or write error: leave no partial output behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return output_path
+
+
+# Thousand separator and two decimals; Excel renders them in the user's locale
+NUMBER_FORMAT = "#,##0.00"
+
+
+def number_cell(sheet, value):
+    """Return a numeric cell for `value` rounded to two decimals."""
+    cell = WriteOnlyCell(sheet, value=round(value, 2))
+    cell.number_format = NUMBER_FORMAT
+    return cell
+
+
+def week_slices(start_ord, n_days):
+    """Split day indices 0..n_days-1 (index 0 being ordinal `start_ord`) into
+    ISO weeks.
+
+    Returns (label, start, stop) tuples, e.g. ("2025-W31", 3, 10), in order.
+    """
+    slices = []
+    start = 0
+    while start < n_days:
+        day = date.fromordinal(start_ord + start)
+        stop = min(start + 7 - day.weekday(), n_days)
+        year, week, _ = day.isocalendar()
+        slices.append((f"{year}-W{week:02d}", start, stop))
+        start = stop
+    return slices
+
+
+class DailyTotals:
+    """Per-day sums of Record values, kept as one float array (column) per
+    metric.
+
+    Column index 0 is the day `start_ord`. With `start` and `end` dates the
+    columns cover exactly that range and other records are ignored; without
+    them the columns grow to cover every record date seen.
+    """
+
+    # Extra days allocated whenever an unbounded range has to grow
+    GROW_BY = 366
+    # Unbounded ranges ignore dates further than this from the first day
+    # seen, so one bogus year (e.g. 0001 or 9999) cannot allocate centuries
+    MAX_SPAN_DAYS = 50 * 366
+
+    def __init__(self, aggregate_map, start=None, end=None):
+        self.metric_keys = list(dict.fromkeys(aggregate_map.values()))
+        self.codes = {
+            dtype: self.metric_keys.index(key) for dtype, key in aggregate_map.items()
+        }
+        self.bounded = start is not None and end is not None
+        if self.bounded:
+            self.start_ord = start.toordinal()
+            self.n_days = end.toordinal() - self.start_ord + 1
+        else:
+            self.start_ord = 0
+            self.n_days = 0
+        # Packed doubles, 8 bytes per day, rather than a list of float objects
+        self.columns = [array("d", [0.0]) * self.n_days for _ in self.metric_keys]
+        self.seen = bytearray(self.n_days)
+        self._ordinals = {}  # "YYYY-MM-DD" -> ordinal, -1 when unusable
+        self._first_ord = None  # first valid day seen, anchors MAX_SPAN_DAYS
+
+    def add(self, record):
+        """Add a Record element's value to its day's column, if aggregated."""
+        get = record.get
+        # Most records are of types that are not aggregated: drop them before
+        # touching the date or the value
+        c = self.codes.get(get("type"))
+        if c is None:
+            return
+
+        # "YYYY-MM-DD HH:MM:SS +ZZZZ": only the local calendar day is used
+        prefix = get("startDate", "")[:10]
+        ordinal = self._ordinals.get(prefix)
+        if ordinal is None:
+            try:
+                d = date(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]))
+                ordinal = d.toordinal()
+            except ValueError:
+                ordinal = -1
+            if self.bounded:
+                if not 0 <= ordinal - self.start_ord < self.n_days:
+                    ordinal = -1
+            elif ordinal >= 0:
+                if self._first_ord is None:
+                    self._first_ord = ordinal
+                elif abs(ordinal - self._first_ord) > self.MAX_SPAN_DAYS:
+                    ordinal = -1
+            self._ordinals[prefix] = ordinal
+        if ordinal < 0:
+            return
+
+        value_str = get("value", "0")
+        try:
+            value = float(value_str)
+        except ValueError:
+            return
+
+        idx = ordinal - self.start_ord
+        if not 0 <= idx < self.n_days:
+            idx = self._grow(ordinal)
+        self.columns[c][idx] += value
+        self.seen[idx] = 1
+
+    def _grow(self, ordinal):
+        """Extend an unbounded range to cover `ordinal`; return its index."""
+        if self.n_days == 0:
+            self.start_ord = ordinal
+        before = max(self.start_ord - ordinal, 0)
+        after = max(ordinal - (self.start_ord + self.n_days - 1), 0)
+        before += self.GROW_BY if before else 0
+        after += self.GROW_BY if after else 0
+        zero = array("d", [0.0])
+        self.columns = [
+            zero * before + column + zero * after for column in self.columns
+        ]
+        self.seen = bytearray(before) + self.seen + bytearray(after)
+        self.start_ord -= before
+        self.n_days += before + after
+        return ordinal - self.start_ord
+
+    def series(self):
+        """Map each metric key to its column."""
+        return dict(zip(self.metric_keys, self.columns))
+
+    def day_indices(self):
+        """Indices of the days that have data, in date order."""
+        return [i for i in range(self.n_days) if self.seen[i]]
+
+    def day(self, idx):
+        """Date of column index `idx`."""
+        return date.fromordinal(self.start_ord + idx)
+
+    def weeks(self):
+        """(label, start, stop) slices of the ISO weeks that have data."""
+        return [
+            (week, a, b)
+            for week, a, b in week_slices(self.start_ord, self.n_days)
+            if any(self.seen[a:b])
+        ]
+
+
+def aggregate_records(xml_path, aggregate_map, start=None, end=None):
+    """Stream the Records of `xml_path` into a DailyTotals."""
+    totals = DailyTotals(aggregate_map, start, end)
+    for record in iter_elements(xml_path):
+        totals.add(record)
+    return totals
+
+
+class JsonPoster:
+    """POST JSON payloads over kept-alive connections, one per host.
+
+    Bodies larger than GZIP_MIN_BYTES are gzip-compressed. Errors are left to
+    the caller, which reports them in its own words.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.connections = {}  # netloc -> open http.client connection
+
+    def _connection(self, parts):
+        """Return the kept-alive connection for a URL's host, opening it if needed."""
+        conn = self.connections.get(parts.netloc)
+        if conn is None:
+            if parts.scheme == "https":
+                conn = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+            self.connections[parts.netloc] = conn
+        return conn
+
+    def _drop(self, netloc):
+        """Close a host's connection; the next post opens a new one."""
+        conn = self.connections.pop(netloc, None)
+        if conn is not None:
+            conn.close()
+
+    def post(self, url, payload, token):
+        """POST `payload` to `url` with a bearer token; return the response.
+
+        The response body is read before returning. A kept-alive connection
+        the server has since closed is retried once on a fresh one. Any other
+        error propagates (http.client.HTTPException, OSError, ValueError or
+        TypeError); after an error or a non-2xx status the connection is
+        dropped, so it is never reused mid-request.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        }
+        if len(data) > GZIP_MIN_BYTES:
+            data = gzip.compress(data, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        for attempt in range(2):
+            reused = parts.netloc in self.connections
+            try:
+                conn = self._connection(parts)
+                conn.request("POST", path, body=data, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (http.client.HTTPException, OSError, ValueError) as e:
+                self._drop(parts.netloc)
+                if reused and attempt == 0 and isinstance(e, STALE_CONNECTION_ERRORS):
+                    continue
+                raise
+            if not 200 <= resp.status < 300:
+                self._drop(parts.netloc)
+            return resp
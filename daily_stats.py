@@ -6,25 +6,31 @@ Apply daily aggregation and export to Excel file with three sheets:
 4. Date range of the data
 """
 
+import os
 import sys
 import statistics
 from datetime import datetime, timezone, time
-import xml.etree.ElementTree as ET
-from collections import defaultdict
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse as urlparse
+import http.client
 import urllib.request as urlrequest
 import urllib.error as urlerror
 import threading
+import functools
 import webbrowser
 import signal
-import time as systime
 import shutil
-import json
-import socket
 from openpyxl import Workbook
 import keyring
 from keyring.errors import KeyringError
+from apple_health_agg import (
+    ET,
+    DailyTotals,
+    JsonPoster,
+    iter_elements,
+    number_cell,
+    write_without,
+)
 
 APP_NAME = "health_dashboard"
 BACKEND = "http://localhost:7384"
@@ -33,32 +39,66 @@ FRONTEND = "http://localhost:3762"
 SERVER_URL = f"{FRONTEND}/oauth/callback"
 HEALTH_CHECK_ENDPOINT = f"{BACKEND}/api/health"
 CRED_KEY = "jwt_token"
+# Token taken as-is when set, skipping the keyring (batch/scripted runs)
+ENV_TOKEN = "HEALTH_TOKEN"
 
 # ---- CONFIG ----
 FILE = "export.xml"
 # ----------------
-tree = ET.parse(FILE)
-root = tree.getroot()
+
+# Backend POSTs, over one kept-alive connection (gzip above GZIP_MIN_BYTES)
+POSTER = JsonPoster(timeout=10)
 
 # Global synchronization primitives for OAuth
 AUTH_SUCCESS = threading.Event()
-SERVER_READY = threading.Event()
-SERVER_STATE = {"instance": None, "port": None}
 CANCEL_EVENT = threading.Event()
+# Seconds to wait for the OAuth callback (the login link is valid for 5 minutes)
+AUTH_TIMEOUT = 300
+
 
+# Tokens the backend rejected this run: a rejected $HEALTH_TOKEN falls back
+# to the keyring, a rejected keyring token to a fresh OAuth login
+TOKEN_STATE = {"env_rejected": False, "keyring_rejected": False}
 
+
+def _env_token():
+    """Return $HEALTH_TOKEN, unless the backend already rejected it."""
+    if TOKEN_STATE["env_rejected"]:
+        return None
+    return os.environ.get(ENV_TOKEN)
+
+
+@functools.lru_cache(maxsize=1)
 def get_stored_token():
-    """Retrieve stored JWT token from keyring."""
+    """Retrieve stored JWT token from $HEALTH_TOKEN or the keyring.
+
+    The lookup is cached for the process; storing or clearing resets it.
+    """
+    token_back = _env_token()
+    if token_back or TOKEN_STATE["keyring_rejected"]:
+        return token_back
     return keyring.get_password(APP_NAME, CRED_KEY)
 
 
 def store_token(token_back: str):
     """Store JWT token securely in keyring."""
     keyring.set_password(APP_NAME, CRED_KEY, token_back)
+    TOKEN_STATE["keyring_rejected"] = False
+    get_stored_token.cache_clear()
 
 
 def clear_stored_token():
-    """Clear stored JWT token from keyring."""
+    """Drop the token that was just rejected.
+
+    A rejected $HEALTH_TOKEN is only skipped from then on, leaving the
+    keyring token (never tried yet) in place; otherwise the keyring entry
+    is skipped and deleted.
+    """
+    get_stored_token.cache_clear()
+    if _env_token():
+        TOKEN_STATE["env_rejected"] = True
+        return
+    TOKEN_STATE["keyring_rejected"] = True
     keyring.delete_password(APP_NAME, CRED_KEY)
 
 
@@ -85,22 +125,31 @@ class CallbackHandler(BaseHTTPRequestHandler):
             self.wfile.write(b"Authentication failed.")
 
 
+def _serve_until_authenticated(httpd):
+    """Answer callback requests until the token has arrived, then close."""
+    with httpd:
+        # handle_request blocks until a request comes in: no polling loop
+        while not AUTH_SUCCESS.is_set():
+            httpd.handle_request()
+
+
 def start_local_server(preferred_port: int = 11011):
-    """Start a local HTTP server to handle OAuth callback (until shutdown).
+    """Start a local HTTP server to handle the OAuth callback.
     Tries preferred_port first, falls back to any free port.
-    Signals readiness via SERVER_READY and records LISTEN_PORT.
+    The socket is bound before returning, so the server's port is usable
+    right away; requests are answered by a daemon thread.
     """
     try:
         httpd = HTTPServer(("127.0.0.1", preferred_port), CallbackHandler)
     except OSError:
         # Fallback to any available port
         httpd = HTTPServer(("127.0.0.1", 0), CallbackHandler)
-    SERVER_STATE["instance"] = httpd
-    SERVER_STATE["port"] = httpd.server_address[1]
-    SERVER_READY.set()
-    print(f"Local callback server listening on http://127.0.0.1:{SERVER_STATE['port']}")
-    # Serve until `shutdown()` is called from the main thread.
-    httpd.serve_forever(poll_interval=0.5)
+    threading.Thread(
+        target=_serve_until_authenticated, args=(httpd,), daemon=True
+    ).start()
+    port = httpd.server_address[1]
+    print(f"Local callback server listening on http://127.0.0.1:{port}")
+    return httpd
 
 
 def ensure_authenticated():
@@ -110,25 +159,14 @@ def ensure_authenticated():
         return token_back
 
     # launch local server in background (prefer 11011)
-    server_thread = threading.Thread(
-        target=start_local_server, kwargs={"preferred_port": 11011}, daemon=True
-    )
-    server_thread.start()
-
-    # wait for server readiness to know the actual port
-    if not SERVER_READY.wait(timeout=5):
-        # could not start server; cancel
-        if SERVER_STATE["instance"] is not None:
-            try:
-                SERVER_STATE["instance"].shutdown()
-            except OSError:
-                pass
-        server_thread.join(timeout=2)
+    try:
+        httpd = start_local_server(preferred_port=11011)
+    except OSError:
         print("❌ Failed to start local callback server.")
         return None
 
     # open browser to authenticate with the actual chosen port
-    redirect_url = f"http://127.0.0.1:{SERVER_STATE['port']}/callback"
+    redirect_url = f"http://127.0.0.1:{httpd.server_address[1]}/callback"
     auth_url = f"{SERVER_URL}?provider={redirect_url}"
     # Log the URL so the user can copy/paste it if needed
     print(
@@ -143,30 +181,13 @@ def ensure_authenticated():
             flush=True,
         )
 
-    # wait up to 5 minutes for authentication to complete; allow Ctrl+C to cancel
-    deadline = systime.monotonic() + 30
-    success = False
-    try:
-        while True:
-            if AUTH_SUCCESS.is_set():
-                success = True
-                break
-            if CANCEL_EVENT.is_set():
-                raise KeyboardInterrupt
-            remaining = deadline - systime.monotonic()
-            if remaining <= 0:
-                success = False
-                break
-            # poll in small intervals to allow signal handling
-            AUTH_SUCCESS.wait(timeout=min(0.25, remaining))
-    finally:
-        # stop the local server regardless of outcome
-        if SERVER_STATE["instance"] is not None:
-            try:
-                SERVER_STATE["instance"].shutdown()
-            except OSError:
-                pass
-        server_thread.join(timeout=2)
+    # wait up to 5 minutes for authentication to complete; Ctrl+C also sets
+    # AUTH_SUCCESS (see _sigint_handler) so the wait returns straight away.
+    # The server thread closes itself once the token is in; on timeout it
+    # is a daemon and goes away with the process.
+    success = AUTH_SUCCESS.wait(timeout=AUTH_TIMEOUT)
+    if CANCEL_EVENT.is_set():
+        raise KeyboardInterrupt
 
     if not success:
         # Timed out or interrupted: cancel process
@@ -194,15 +215,18 @@ def validate_token(jwt_token: str, endpoint: str = HEALTH_CHECK_ENDPOINT) -> boo
         print(f"❌ Token validation failed: {e}")
         return False
 
-def format_number(value, width=10):
-    """
-    Format a number with:
-    - Thousand separator (.)
-    - Decimal comma (,)
-    - Left-padded with spaces to a total width
-    """
-    formatted = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-    return formatted.rjust(width, " ")
+
+# Sheet column titles per metric key; unknown keys are title-cased
+METRIC_LABELS = {
+    "steps": "Steps",
+    "distance": "Distance (km)",
+    "calories": "Active Calories (kcal)",
+    "basal_calories": "Basal Calories (kcal)",
+    "flights": "Flights",
+    "exercise": "Exercise (minutes)",
+}
+# Metrics written with two decimals; the others are rounded to whole numbers
+DECIMAL_METRICS = {"distance"}
 
 
 def finall_and_delete(output_path=None, make_backup=False):
@@ -222,14 +246,6 @@ def finall_and_delete(output_path=None, make_backup=False):
         else:
             output_path = FILE + "_cleaned"
 
-    # Remove all Record nodes
-    records = list(root.findall(".//Record"))
-    for record in records:
-        root.remove(record)
-    records = list(root.findall(".//ActivitySummary"))
-    for record in records:
-        root.remove(record)
-
     # Optional backup if overwriting original
     if make_backup and output_path == FILE:
         try:
@@ -237,48 +253,33 @@ def finall_and_delete(output_path=None, make_backup=False):
         except OSError:
             pass
 
-    # Pretty-print and write
+    # Stream everything but Record / ActivitySummary nodes, pretty-printed
     try:
-        try:
-            ET.indent(tree, space="  ")  # Python 3.9+
-        except AttributeError:
-            pass
-        tree.write(output_path, encoding="utf-8", xml_declaration=True)
+        write_without(FILE, output_path, ("Record", "ActivitySummary"))
         print(f"✅ Saved cleaned XML to '{output_path}'")
         return output_path
-    except OSError as e:
+    except (OSError, ET.ParseError) as e:
         print(f"❌ Failed to write cleaned XML: {e}")
         return output_path
 
 
 def _post_json(url: str, payload: dict, jwt_token: str) -> bool:
     try:
-        data = json.dumps(payload).encode("utf-8")
-        req = urlrequest.Request(
-            url,
-            data=data,
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {jwt_token}",
-            },
-            method="POST",
-        )
-        with urlrequest.urlopen(req, timeout=10) as resp:
-            return 200 <= resp.status < 300
-    except (urlerror.URLError, urlerror.HTTPError, socket.timeout) as e:
+        resp = POSTER.post(url, payload, jwt_token)
+    except (http.client.HTTPException, OSError, ValueError, TypeError) as e:
         print(f"❌ POST {url} failed: {e}")
         return False
+    if 200 <= resp.status < 300:
+        return True
+    print(f"❌ POST {url} failed: HTTP Error {resp.status}: {resp.reason}")
+    return False
 
 
-def _derive_export_date_str() -> str | None:
+def _derive_export_date_str(elem) -> str | None:
     try:
-        elem = root.find(".//ExportDate")
         if elem is None:
             return None
-        val = None
-        if hasattr(elem, "attrib") and isinstance(elem.attrib, dict):
-            val = elem.attrib.get("value") or elem.attrib.get("date")
+        val = elem.get("value") or elem.get("date")
         if not val:
             val = (elem.text or "").strip()
         if not val:
@@ -295,52 +296,30 @@ def _derive_export_date_str() -> str | None:
         return None
 
 
-def export_excel(_start, _end, jwt_token=None):
-    """Export daily and weekly aggregated data to an Excel file."""
-    # ---- Aggregate daily data ----
-    # ---- Aggregate daily data ----
-    initial_state = {
-        "steps": 0,
-        "distance": 0,
-        "calories": 0,
-        "basal_calories": 0,
-        "flights": 0,
-        "exercise": 0,
-    }
+def _round_int(v):
+    """Summary value rounded to a whole number (0 if not numeric)."""
+    try:
+        return int(round(float(v)))
+    except (ValueError, TypeError):
+        return 0
 
-    daily_data = defaultdict(lambda: initial_state)
 
-    # ---- Aggregate weekly data ----
-    weekly_data = defaultdict(lambda: initial_state)
-
-    # Gather meta
-    me_elem = root.find(".//Me")
-    me_attrs = me_elem.attrib if me_elem is not None else {}
-    export_date_str = _derive_export_date_str()
-    # for record in root.findall(".//ActivitySummary"):
-    #     print(record.attrib)
-
-    record_dtypes = [
-        "HKQuantityTypeIdentifierStepCount",
-        "HKQuantityTypeIdentifierDistanceWalkingRunning",
-        "HKQuantityTypeIdentifierActiveEnergyBurned",
-        "HKQuantityTypeIdentifierBasalEnergyBurned",
-        "HKQuantityTypeIdentifierFlightsClimbed",
-        "HKQuantityTypeIdentifierAppleExerciseTime",
-        "HKQuantityTypeIdentifierHeadphoneAudioExposure",
-        "HKQuantityTypeIdentifierWalkingDoubleSupportPercentage",
-        "HKQuantityTypeIdentifierWalkingSpeed",
-        "HKQuantityTypeIdentifierWalkingStepLength",
-        "HKQuantityTypeIdentifierWalkingAsymmetryPercentage",
-        "HKQuantityTypeIdentifierAppleWalkingSteadiness",
-        "HKCategoryTypeIdentifierSleepAnalysis",
-        "HKCategoryTypeIdentifierHeadphoneAudioExposureEvent",
-        "HKQuantityTypeIdentifierHeight",
-        "HKQuantityTypeIdentifierBodyMass",
-        "HKDataTypeSleepDurationGoal",
-    ]
+def _round_dec(v):
+    """Summary value rounded to four decimals (0.0 if not numeric)."""
+    try:
+        return round(float(v), 4)
+    except (ValueError, TypeError):
+        return 0.0
 
-    # Map HealthKit record types to our daily_data keys
+
+def export_excel(_start, _end, jwt_token=None, xml_path=FILE):
+    """Export daily and weekly aggregated data to an Excel file."""
+    # Meta gathered during the single pass below
+    me_attrs = {}
+    export_date_str = None
+    act_summaries = []
+
+    # Map HealthKit record types to our metric keys
     aggregate_map = {
         "HKQuantityTypeIdentifierStepCount": "steps",
         "HKQuantityTypeIdentifierDistanceWalkingRunning": "distance",
@@ -363,53 +342,50 @@ def export_excel(_start, _end, jwt_token=None):
         k for k in metric_keys if k not in preferred_order
     ]
 
-    # Reinitialize containers dynamically (overrides earlier static init)
-    daily_data = defaultdict(lambda: {k: 0 for k in metric_keys})
-    weekly_data = defaultdict(lambda: {k: 0 for k in metric_keys})
-
-    def metric_label(key: str) -> str:
-        mapping = {
-            "steps": "Steps",
-            "distance": "Distance (km)",
-            "calories": "Active Calories (kcal)",
-            "basal_calories": "Basal Calories (kcal)",
-            "flights": "Flights",
-            "exercise": "Exercise (minutes)",
-        }
-        return mapping.get(key, key.replace("_", " ").title())
-
-    def format_cell(key: str, value: float):
-        if key == "distance":
-            return format_number(round(value, 2))
-        return int(round(value))
-
-    for record in root.findall(".//Record"):
-        dtype = record.attrib.get("type")
+    start_d = _start.date()
+    end_d = _end.date()
+    totals = DailyTotals(aggregate_map, start_d, end_d)
 
-        try:
-            startdate = record.attrib.get("startDate")
-            dt = datetime.fromisoformat(startdate.replace(" +", "+"))
-        except ValueError:
-            continue
-
-        if _start <= dt <= _end:
-            value_str = record.attrib.get("value", "0")
+    labels = [
+        METRIC_LABELS.get(k, k.replace("_", " ").title()) for k in ordered_keys
+    ]
+    # Per output column: two-decimal number cell, or a whole number
+    decimal_flags = [k in DECIMAL_METRICS for k in ordered_keys]
+
+    for elem in iter_elements(
+        xml_path, ("ExportDate", "Me", "ActivitySummary", "Record")
+    ):
+        if elem.tag == "Record":
+            totals.add(elem)
+        elif elem.tag == "ExportDate":
+            export_date_str = _derive_export_date_str(elem)
+        elif elem.tag == "Me":
+            me_attrs = dict(elem.attrib)
+        elif elem.tag == "ActivitySummary":
+            # activity summaries (filtered by date range if possible)
+            attrs = dict(elem.attrib)
+            dc = attrs.get("dateComponents")
             try:
-                value = float(value_str)
+                if dc:
+                    d = datetime.strptime(dc, "%Y-%m-%d").date()
+                    if not start_d <= d <= end_d:
+                        continue
             except ValueError:
-                continue
+                # Skip malformed date strings in activity summaries
+                pass
+            act_summaries.append(attrs)
 
-            day_key = dt.date()
-            # Dynamic aggregation based on allowed dtypes
-            if dtype in record_dtypes and dtype in aggregate_map:
-                key = aggregate_map[dtype]
-                daily_data[day_key][key] += value
+    series = totals.series()
+    # Indices of the days that have data, and their dates, in date order
+    days = totals.day_indices()
+    dates = [totals.day(i) for i in days]
 
-    for day, data in daily_data.items():
-        year, week, _ = day.isocalendar()
-        week_key = f"{year}-W{week:02d}"
-        for k in metric_keys:
-            weekly_data[week_key][k] += data[k]
+    # ---- Aggregate weekly data ----
+    # Sum each column over the ISO weeks that have data
+    weekly_data = {
+        week: {k: sum(series[k][a:b]) for k in metric_keys}
+        for week, a, b in totals.weeks()
+    }
 
     # ---- Post data to backend (optional) ----
     if jwt_token:
@@ -420,27 +396,15 @@ def export_excel(_start, _end, jwt_token=None):
         # 2) daily summaries
         # Build per-day summary objects to match DailySummary schema
         summaries_payload = []
-        for day, metrics in daily_data.items():
-            def _int(v):
-                try:
-                    return int(round(float(v)))
-                except (ValueError, TypeError):
-                    return 0
-
-            def _dec(v):
-                try:
-                    return round(float(v), 4)
-                except (ValueError, TypeError):
-                    return 0.0
-
+        for i, day in zip(days, dates):
             item = {
                 "date": day.isoformat(),
-                "steps": _int(metrics.get("steps", 0)),
-                "flights": _int(metrics.get("flights", 0)),
-                "distance": _dec(metrics.get("distance", 0)),
-                "active": _dec(metrics.get("calories", 0)),
-                "basal": _dec(metrics.get("basal_calories", 0)),
-                "exercise": _dec(metrics.get("exercise", 0)),
+                "steps": _round_int(series["steps"][i]),
+                "flights": _round_int(series["flights"][i]),
+                "distance": _round_dec(series["distance"][i]),
+                "active": _round_dec(series["calories"][i]),
+                "basal": _round_dec(series["basal_calories"][i]),
+                "exercise": _round_dec(series["exercise"][i]),
             }
             if export_date_str:
                 item["exportDate"] = export_date_str
@@ -452,20 +416,7 @@ def export_excel(_start, _end, jwt_token=None):
             jwt_token,
         )
 
-        # 3) activity summaries (filtered by date range if possible)
-        act_summaries = []
-        for rec in root.findall(".//ActivitySummary"):
-            attrs = dict(rec.attrib)
-            dc = attrs.get("dateComponents")
-            try:
-                if dc:
-                    d = datetime.strptime(dc, "%Y-%m-%d").date()
-                    if not _start.date() <= d <= _end.date():
-                        continue
-            except ValueError:
-                # Skip malformed date strings in activity summaries
-                pass
-            act_summaries.append(attrs)
+        # 3) activity summaries (collected during the pass above)
         _post_json(
             f"{BACKEND}/api/apple-health/activity-summaries",
             {"exportDate": export_date_str, "summaries": act_summaries},
@@ -473,23 +424,28 @@ def export_excel(_start, _end, jwt_token=None):
         )
 
     # ---- Create Excel file ----
-    wb = Workbook()
+    # Write-only mode streams rows to disk instead of keeping Cell objects
+    wb = Workbook(write_only=True)
 
     # --- Daily Sheet ---
-    daily_sheet = wb.active
-    daily_sheet.title = "Daily Totals"
-    daily_sheet.append(["Date"] + [metric_label(k) for k in ordered_keys])
-    for day in sorted(daily_data.keys()):
-        data = daily_data[day]
-        row = [day.isoformat()] + [format_cell(k, data[k]) for k in ordered_keys]
+    daily_sheet = wb.create_sheet(title="Daily Totals")
+    daily_sheet.append(["Date"] + labels)
+    columns = [series[k] for k in ordered_keys]
+    for i, day in zip(days, dates):
+        row = [day.isoformat()] + [
+            number_cell(daily_sheet, col[i]) if dec else int(round(col[i]))
+            for col, dec in zip(columns, decimal_flags)
+        ]
         daily_sheet.append(row)
 
     # --- Weekly Sheet ---
     weekly_sheet = wb.create_sheet(title="Weekly Totals")
-    weekly_sheet.append(["Week"] + [metric_label(k) for k in ordered_keys])
-    for week in sorted(weekly_data.keys()):
-        data = weekly_data[week]
-        row = [week] + [format_cell(k, data[k]) for k in ordered_keys]
+    weekly_sheet.append(["Week"] + labels)
+    for week, data in weekly_data.items():
+        row = [week] + [
+            number_cell(weekly_sheet, data[k]) if dec else int(round(data[k]))
+            for k, dec in zip(ordered_keys, decimal_flags)
+        ]
         weekly_sheet.append(row)
 
     # --- Daily Statistics Sheet ---
@@ -507,41 +463,36 @@ def export_excel(_start, _end, jwt_token=None):
         ]
     )
 
-    # Prepare lists and corresponding dates dynamically
-    all_dates = list(daily_data.keys())
-    series_by_key = {k: [data[k] for data in daily_data.values()] for k in ordered_keys}
-
-    def get_day_of_value(lst, dates, value):
-        """Return the first date corresponding to the value"""
-        for v, d in zip(lst, dates):
-            if v == value:
-                return d.isoformat()
-        return ""
+    # Prepare lists for the days that have data
+    series_by_key = {k: [series[k][i] for i in days] for k in ordered_keys}
 
-    metrics = [(metric_label(k), series_by_key[k], all_dates) for k in ordered_keys]
+    metrics = [
+        (label, series_by_key[k], dates) for label, k in zip(labels, ordered_keys)
+    ]
 
     for name, lst, dates in metrics:
-        max_val = max(lst)
-        min_val = min(lst)
+        # First day hitting the max / min, as an index into `dates`
+        i_max = max(range(len(lst)), key=lst.__getitem__)
+        i_min = min(range(len(lst)), key=lst.__getitem__)
         stats_sheet.append(
             [
                 name,
-                format_number(round(sum(lst), 2)),
-                format_number(round(max_val, 2)),
-                get_day_of_value(lst, dates, max_val),
-                format_number(round(min_val, 2)),
-                get_day_of_value(lst, dates, min_val),
-                format_number(round(statistics.median(lst), 2)),
-                format_number(round(statistics.mean(lst), 2)),
+                number_cell(stats_sheet, sum(lst)),
+                number_cell(stats_sheet, lst[i_max]),
+                dates[i_max].isoformat(),
+                number_cell(stats_sheet, lst[i_min]),
+                dates[i_min].isoformat(),
+                number_cell(stats_sheet, statistics.median(lst)),
+                number_cell(stats_sheet, statistics.fmean(lst)),
             ]
         )
     stats_sheet.append(
         [
             "Date Range",
             "Start Date",
-            min(daily_data.keys()).isoformat(),
+            dates[0].isoformat(),
             "End Date",
-            max(daily_data.keys()).isoformat(),
+            dates[-1].isoformat(),
         ]
     )
     output_xlsx = f"activity_summaries/{_start.date()}-{_end.date()}.xlsx"
@@ -550,46 +501,20 @@ def export_excel(_start, _end, jwt_token=None):
     print(f"Daily, weekly, and daily stats summary exported to '{output_xlsx}'")
 
 
-# --- 1️⃣ Parse CMD Arguments ---
-if len(sys.argv) != 3:
-    print("Usage: python daily_stats.py <start_date> <end_date>")
-    print("Example: python daily_stats.py 2025-08-01 2025-08-31")
-    sys.exit(1)
-
-
 def _sigint_handler(_signum, _frame):
     CANCEL_EVENT.set()
+    # Wake ensure_authenticated, which is blocked on this event
+    AUTH_SUCCESS.set()
 
 
-try:
-    # install Ctrl+C handler
-    try:
-        signal.signal(signal.SIGINT, _sigint_handler)
-    except ValueError:
-        # In some environments signals may not be configurable; ignore
-        pass
-    start_date = datetime.combine(
-        datetime.strptime(sys.argv[1], "%Y-%m-%d").date(), time.min, tzinfo=timezone.utc
-    )
-    end_date = datetime.combine(
-        datetime.strptime(sys.argv[2], "%Y-%m-%d").date(), time.max, tzinfo=timezone.utc
-    )
+def authenticate_or_exit():
+    """Return a token the backend accepts, or exit.
 
-    token = ensure_authenticated()
-    if CANCEL_EVENT.is_set():
-        print("\nOperation cancelled by user.")
-        sys.exit(1)
-    if not token:
-        print("⚠️ Authentication timed out (5 minutes). Process cancelled.")
-        sys.exit(1)
-    # Validate token with local API before proceeding; if invalid, start OAuth
-    if not validate_token(token):
-        print("⚠️ Stored token invalid. Starting OAuth re-authentication…")
-        try:
-            print("Clearing stored token.")
-            clear_stored_token()
-        except KeyringError:
-            pass
+    Tries $HEALTH_TOKEN, then the keyring token, then a fresh OAuth login,
+    moving on whenever the backend rejects the current one.
+    """
+    while True:
+        from_oauth = not get_stored_token()
         token = ensure_authenticated()
         if CANCEL_EVENT.is_set():
             print("\nOperation cancelled by user.")
@@ -597,19 +522,59 @@ try:
         if not token:
             print("⚠️ Authentication timed out (5 minutes). Process cancelled.")
             sys.exit(1)
-        if not validate_token(token):
+        # Validate token with local API before proceeding
+        if validate_token(token):
+            return token
+        if from_oauth:
             print("❌ Authentication failed: token invalid after re-authentication.")
             sys.exit(1)
-    export_excel(start_date, end_date, token)
-except ValueError:
-    print("❌ Dates must be in YYYY-MM-DD format")
-    sys.exit(1)
-except KeyboardInterrupt:
-    # Ensure server is shut down if running and exit cleanly
-    if SERVER_STATE["instance"] is not None:
         try:
-            SERVER_STATE["instance"].shutdown()
-        except OSError:
+            print("⚠️ Stored token invalid. Clearing stored token.")
+            clear_stored_token()
+        except KeyringError:
             pass
-    print("\nOperation cancelled by user.")
-    sys.exit(1)
+        if get_stored_token():
+            print("Trying the token stored in the keyring…")
+        else:
+            print("Starting OAuth re-authentication…")
+
+
+def main():
+    """Authenticate, then export the date range given on the command line."""
+    # --- 1️⃣ Parse CMD Arguments ---
+    if len(sys.argv) != 3:
+        print("Usage: python daily_stats.py <start_date> <end_date>")
+        print("Example: python daily_stats.py 2025-08-01 2025-08-31")
+        sys.exit(1)
+
+    try:
+        # install Ctrl+C handler
+        try:
+            signal.signal(signal.SIGINT, _sigint_handler)
+        except ValueError:
+            # In some environments signals may not be configurable; ignore
+            pass
+        start_date = datetime.combine(
+            datetime.strptime(sys.argv[1], "%Y-%m-%d").date(),
+            time.min,
+            tzinfo=timezone.utc,
+        )
+        end_date = datetime.combine(
+            datetime.strptime(sys.argv[2], "%Y-%m-%d").date(),
+            time.max,
+            tzinfo=timezone.utc,
+        )
+
+        token = authenticate_or_exit()
+        export_excel(start_date, end_date, token)
+    except ValueError:
+        print("❌ Dates must be in YYYY-MM-DD format")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # The callback server thread is a daemon; just exit cleanly
+        print("\nOperation cancelled by user.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
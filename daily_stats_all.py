@@ -6,23 +6,28 @@ Apply daily aggregation and export to Excel file with three sheets:
 4. Date range of the data
 """
 
+import os
 import sys
 from datetime import datetime
-import xml.etree.ElementTree as ET
-from collections import defaultdict
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse as urlparse
+import http.client
 import urllib.request as urlrequest
 import urllib.error as urlerror
 import threading
+import functools
 import webbrowser
 import signal
-import time as systime
 import shutil
-import json
-import socket
 import keyring
 from keyring.errors import KeyringError
+from apple_health_agg import (
+    ET,
+    DailyTotals,
+    JsonPoster,
+    iter_elements,
+    write_without,
+)
 
 APP_NAME = "health_dashboard"
 BACKEND = "http://localhost:7384"
@@ -31,32 +36,65 @@ FRONTEND = "http://localhost:3762"
 SERVER_URL = f"{FRONTEND}/oauth/callback"
 HEALTH_CHECK_ENDPOINT = f"{BACKEND}/api/health"
 CRED_KEY = "jwt_token"
+# Token taken as-is when set, skipping the keyring (batch/scripted runs)
+ENV_TOKEN = "HEALTH_TOKEN"
 
 # ---- CONFIG ----
 FILE = "export.xml"
 # ----------------
-tree = ET.parse(FILE)
-root = tree.getroot()
 
 # Global synchronization primitives for OAuth
 AUTH_SUCCESS = threading.Event()
-SERVER_READY = threading.Event()
-SERVER_STATE = {"instance": None, "port": None}
 CANCEL_EVENT = threading.Event()
+# Backend POSTs, kept alive across batches (gzip above GZIP_MIN_BYTES)
+POSTER = JsonPoster(timeout=10)
+# Seconds to wait for the OAuth callback (the login link is valid for 5 minutes)
+AUTH_TIMEOUT = 300
 
 
+# Tokens the backend rejected this run: a rejected $HEALTH_TOKEN falls back
+# to the keyring, a rejected keyring token to a fresh OAuth login
+TOKEN_STATE = {"env_rejected": False, "keyring_rejected": False}
+
+
+def _env_token():
+    """Return $HEALTH_TOKEN, unless the backend already rejected it."""
+    if TOKEN_STATE["env_rejected"]:
+        return None
+    return os.environ.get(ENV_TOKEN)
+
+
+@functools.lru_cache(maxsize=1)
 def get_stored_token():
-    """Retrieve stored JWT token from keyring."""
+    """Retrieve stored JWT token from $HEALTH_TOKEN or the keyring.
+
+    The lookup is cached for the process; storing or clearing resets it.
+    """
+    token_back = _env_token()
+    if token_back or TOKEN_STATE["keyring_rejected"]:
+        return token_back
     return keyring.get_password(APP_NAME, CRED_KEY)
 
 
 def store_token(token_back: str):
     """Store JWT token securely in keyring."""
     keyring.set_password(APP_NAME, CRED_KEY, token_back)
+    TOKEN_STATE["keyring_rejected"] = False
+    get_stored_token.cache_clear()
 
 
 def clear_stored_token():
-    """Clear stored JWT token from keyring."""
+    """Drop the token that was just rejected.
+
+    A rejected $HEALTH_TOKEN is only skipped from then on, leaving the
+    keyring token (never tried yet) in place; otherwise the keyring entry
+    is skipped and deleted.
+    """
+    get_stored_token.cache_clear()
+    if _env_token():
+        TOKEN_STATE["env_rejected"] = True
+        return
+    TOKEN_STATE["keyring_rejected"] = True
     keyring.delete_password(APP_NAME, CRED_KEY)
 
 
@@ -83,22 +121,31 @@ class CallbackHandler(BaseHTTPRequestHandler):
             self.wfile.write(b"Authentication failed.")
 
 
+def _serve_until_authenticated(httpd):
+    """Answer callback requests until the token has arrived, then close."""
+    with httpd:
+        # handle_request blocks until a request comes in: no polling loop
+        while not AUTH_SUCCESS.is_set():
+            httpd.handle_request()
+
+
 def start_local_server(preferred_port: int = 11011):
-    """Start a local HTTP server to handle OAuth callback (until shutdown).
+    """Start a local HTTP server to handle the OAuth callback.
     Tries preferred_port first, falls back to any free port.
-    Signals readiness via SERVER_READY and records LISTEN_PORT.
+    The socket is bound before returning, so the server's port is usable
+    right away; requests are answered by a daemon thread.
     """
     try:
         httpd = HTTPServer(("127.0.0.1", preferred_port), CallbackHandler)
     except OSError:
         # Fallback to any available port
         httpd = HTTPServer(("127.0.0.1", 0), CallbackHandler)
-    SERVER_STATE["instance"] = httpd
-    SERVER_STATE["port"] = httpd.server_address[1]
-    SERVER_READY.set()
-    print(f"Local callback server listening on http://127.0.0.1:{SERVER_STATE['port']}")
-    # Serve until `shutdown()` is called from the main thread.
-    httpd.serve_forever(poll_interval=0.5)
+    threading.Thread(
+        target=_serve_until_authenticated, args=(httpd,), daemon=True
+    ).start()
+    port = httpd.server_address[1]
+    print(f"Local callback server listening on http://127.0.0.1:{port}")
+    return httpd
 
 
 def ensure_authenticated():
@@ -108,25 +155,14 @@ def ensure_authenticated():
         return token_back
 
     # launch local server in background (prefer 11011)
-    server_thread = threading.Thread(
-        target=start_local_server, kwargs={"preferred_port": 11011}, daemon=True
-    )
-    server_thread.start()
-
-    # wait for server readiness to know the actual port
-    if not SERVER_READY.wait(timeout=5):
-        # could not start server; cancel
-        if SERVER_STATE["instance"] is not None:
-            try:
-                SERVER_STATE["instance"].shutdown()
-            except OSError:
-                pass
-        server_thread.join(timeout=2)
+    try:
+        httpd = start_local_server(preferred_port=11011)
+    except OSError:
         print("❌ Failed to start local callback server.")
         return None
 
     # open browser to authenticate with the actual chosen port
-    redirect_url = f"http://127.0.0.1:{SERVER_STATE['port']}/callback"
+    redirect_url = f"http://127.0.0.1:{httpd.server_address[1]}/callback"
     auth_url = f"{SERVER_URL}?provider={redirect_url}"
     # Log the URL so the user can copy/paste it if needed
     print(
@@ -141,30 +177,13 @@ def ensure_authenticated():
             flush=True,
         )
 
-    # wait up to 5 minutes for authentication to complete; allow Ctrl+C to cancel
-    deadline = systime.monotonic() + 30
-    success = False
-    try:
-        while True:
-            if AUTH_SUCCESS.is_set():
-                success = True
-                break
-            if CANCEL_EVENT.is_set():
-                raise KeyboardInterrupt
-            remaining = deadline - systime.monotonic()
-            if remaining <= 0:
-                success = False
-                break
-            # poll in small intervals to allow signal handling
-            AUTH_SUCCESS.wait(timeout=min(0.25, remaining))
-    finally:
-        # stop the local server regardless of outcome
-        if SERVER_STATE["instance"] is not None:
-            try:
-                SERVER_STATE["instance"].shutdown()
-            except OSError:
-                pass
-        server_thread.join(timeout=2)
+    # wait up to 5 minutes for authentication to complete; Ctrl+C also sets
+    # AUTH_SUCCESS (see _sigint_handler) so the wait returns straight away.
+    # The server thread closes itself once the token is in; on timeout it
+    # is a daemon and goes away with the process.
+    success = AUTH_SUCCESS.wait(timeout=AUTH_TIMEOUT)
+    if CANCEL_EVENT.is_set():
+        raise KeyboardInterrupt
 
     if not success:
         # Timed out or interrupted: cancel process
@@ -193,17 +212,6 @@ def validate_token(jwt_token: str, endpoint: str = HEALTH_CHECK_ENDPOINT) -> boo
         return False
 
 
-def format_number(value, width=10):
-    """
-    Format a number with:
-    - Thousand separator (.)
-    - Decimal comma (,)
-    - Left-padded with spaces to a total width
-    """
-    formatted = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-    return formatted.rjust(width, " ")
-
-
 def finall_and_delete(output_path=None, make_backup=False):
     """Remove all Record elements from the XML tree and save to file.
 
@@ -221,14 +229,6 @@ def finall_and_delete(output_path=None, make_backup=False):
         else:
             output_path = FILE + "_cleaned"
 
-    # Remove all Record nodes
-    records = list(root.findall(".//Record"))
-    for record in records:
-        root.remove(record)
-    records = list(root.findall(".//ActivitySummary"))
-    for record in records:
-        root.remove(record)
-
     # Optional backup if overwriting original
     if make_backup and output_path == FILE:
         try:
@@ -236,38 +236,26 @@ def finall_and_delete(output_path=None, make_backup=False):
         except OSError:
             pass
 
-    # Pretty-print and write
+    # Stream everything but Record / ActivitySummary nodes, pretty-printed
     try:
-        try:
-            ET.indent(tree, space="  ")  # Python 3.9+
-        except AttributeError:
-            pass
-        tree.write(output_path, encoding="utf-8", xml_declaration=True)
+        write_without(FILE, output_path, ("Record", "ActivitySummary"))
         print(f"✅ Saved cleaned XML to '{output_path}'")
         return output_path
-    except OSError as e:
+    except (OSError, ET.ParseError) as e:
         print(f"❌ Failed to write cleaned XML: {e}")
         return output_path
 
 
 def _post_json(url: str, payload: dict, jwt_token: str) -> bool:
     try:
-        data = json.dumps(payload).encode("utf-8")
-        req = urlrequest.Request(
-            url,
-            data=data,
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {jwt_token}",
-            },
-            method="POST",
-        )
-        with urlrequest.urlopen(req, timeout=10) as resp:
-            return 200 <= resp.status < 300
-    except (urlerror.URLError, urlerror.HTTPError, socket.timeout) as e:
+        resp = POSTER.post(url, payload, jwt_token)
+    except (http.client.HTTPException, OSError, ValueError, TypeError) as e:
         print(f"❌ POST {url} failed: {e}")
         return False
+    if 200 <= resp.status < 300:
+        return True
+    print(f"❌ POST {url} failed: HTTP Error {resp.status}: {resp.reason}")
+    return False
 
 
 def _post_in_batches(
@@ -291,14 +279,11 @@ def _post_in_batches(
     return True
 
 
-def _derive_export_date_str() -> str | None:
+def _derive_export_date_str(elem) -> str | None:
     try:
-        elem = root.find(".//ExportDate")
         if elem is None:
             return None
-        val = None
-        if hasattr(elem, "attrib") and isinstance(elem.attrib, dict):
-            val = elem.attrib.get("value") or elem.attrib.get("date")
+        val = elem.get("value") or elem.get("date")
         if not val:
             val = (elem.text or "").strip()
         if not val:
@@ -315,56 +300,30 @@ def _derive_export_date_str() -> str | None:
         return None
 
 
-def export_excel(jwt_token=None):
-    """Export daily and weekly aggregated data to an Excel file."""
-    # ---- Aggregate daily data ----
-    # ---- Aggregate daily data ----
-    initial_state = {
-        "steps": 0,
-        "distance": 0,
-        "calories": 0,
-        "basal_calories": 0,
-        "flights": 0,
-        "exercise": 0,
-    }
+def _round_int(v):
+    """Summary value rounded to a whole number (0 if not numeric)."""
+    try:
+        return int(round(float(v)))
+    except (ValueError, TypeError):
+        return 0
 
-    daily_data = defaultdict(lambda: initial_state)
 
-    # ---- Aggregate weekly data ----
-    weekly_data = defaultdict(lambda: initial_state)
+def _round_dec(v):
+    """Summary value rounded to four decimals (0.0 if not numeric)."""
+    try:
+        return round(float(v), 4)
+    except (ValueError, TypeError):
+        return 0.0
+
 
-    # Gather meta
-    me_elem = root.find(".//Me")
-    weight = root.find(".//Record[@type='HKQuantityTypeIdentifierBodyMass']")
-    height = root.find(".//Record[@type='HKQuantityTypeIdentifierHeight']")
-    me_attrs = me_elem.attrib if me_elem is not None else {}
-    if weight is not None:
-        me_attrs["weightInKilograms"] = weight.attrib.get("value")
-    if height is not None:
-        me_attrs["heightInCentimeters"] = height.attrib.get("value")
-    export_date_str = _derive_export_date_str()
-    # for record in root.findall(".//ActivitySummary"):
-    #     print(record.attrib)
-
-    record_dtypes = [
-        "HKQuantityTypeIdentifierStepCount",
-        "HKQuantityTypeIdentifierDistanceWalkingRunning",
-        "HKQuantityTypeIdentifierActiveEnergyBurned",
-        "HKQuantityTypeIdentifierBasalEnergyBurned",
-        "HKQuantityTypeIdentifierFlightsClimbed",
-        "HKQuantityTypeIdentifierAppleExerciseTime",
-        "HKQuantityTypeIdentifierHeadphoneAudioExposure",
-        "HKQuantityTypeIdentifierWalkingDoubleSupportPercentage",
-        "HKQuantityTypeIdentifierWalkingSpeed",
-        "HKQuantityTypeIdentifierWalkingStepLength",
-        "HKQuantityTypeIdentifierWalkingAsymmetryPercentage",
-        "HKQuantityTypeIdentifierAppleWalkingSteadiness",
-        "HKCategoryTypeIdentifierSleepAnalysis",
-        "HKCategoryTypeIdentifierHeadphoneAudioExposureEvent",
-        "HKQuantityTypeIdentifierHeight",
-        "HKQuantityTypeIdentifierBodyMass",
-        "HKDataTypeSleepDurationGoal",
-    ]
+def export_excel(jwt_token=None, xml_path=FILE):
+    """Export daily and weekly aggregated data to an Excel file."""
+    # Meta gathered during the single pass below
+    me_attrs = {}
+    weight = None
+    height = None
+    export_date_str = None
+    act_summaries = []
 
     # Map HealthKit record types to our daily_data keys
     aggregate_map = {
@@ -375,39 +334,35 @@ def export_excel(jwt_token=None):
         "HKQuantityTypeIdentifierFlightsClimbed": "flights",
         "HKQuantityTypeIdentifierAppleExerciseTime": "exercise",
     }
-    # Dynamic keys and preferred order
-    metric_keys = list(dict.fromkeys(aggregate_map.values()))
-
-    # Reinitialize containers dynamically (overrides earlier static init)
-    daily_data = defaultdict(lambda: {k: 0 for k in metric_keys})
-    weekly_data = defaultdict(lambda: {k: 0 for k in metric_keys})
-
-    for record in root.findall(".//Record"):
-        dtype = record.attrib.get("type")
-
-        try:
-            startdate = record.attrib.get("startDate")
-            dt = datetime.fromisoformat(startdate.replace(" +", "+"))
-        except ValueError:
+    # Per-day sums over every record date in the export
+    totals = DailyTotals(aggregate_map)
+
+    for record in iter_elements(
+        xml_path, ("ExportDate", "Me", "ActivitySummary", "Record")
+    ):
+        if record.tag == "ExportDate":
+            export_date_str = _derive_export_date_str(record)
             continue
-
-        value_str = record.attrib.get("value", "0")
-        try:
-            value = float(value_str)
-        except ValueError:
+        if record.tag == "Me":
+            me_attrs = dict(record.attrib)
+            continue
+        if record.tag == "ActivitySummary":
+            act_summaries.append(dict(record.attrib))
             continue
 
-        day_key = dt.date()
-        # Dynamic aggregation based on allowed dtypes
-        if dtype in record_dtypes and dtype in aggregate_map:
-            key = aggregate_map[dtype]
-            daily_data[day_key][key] += value
+        dtype = record.get("type")
+        # First body mass / height records in the file, as before
+        if weight is None and dtype == "HKQuantityTypeIdentifierBodyMass":
+            weight = record.get("value")
+        elif height is None and dtype == "HKQuantityTypeIdentifierHeight":
+            height = record.get("value")
+
+        totals.add(record)
 
-    for day, data in daily_data.items():
-        year, week, _ = day.isocalendar()
-        week_key = f"{year}-W{week:02d}"
-        for k in metric_keys:
-            weekly_data[week_key][k] += data[k]
+    if weight is not None:
+        me_attrs["weightInKilograms"] = weight
+    if height is not None:
+        me_attrs["heightInCentimeters"] = height
 
     # ---- Post data to backend (optional) ----
     if jwt_token:
@@ -419,29 +374,17 @@ def export_excel(jwt_token=None):
 
         # 2) daily summaries
         # Build per-day summary objects to match DailySummary schema
+        series = totals.series()
         summaries_payload = []
-        for day, metrics in daily_data.items():
-
-            def _int(v):
-                try:
-                    return int(round(float(v)))
-                except (ValueError, TypeError):
-                    return 0
-
-            def _dec(v):
-                try:
-                    return round(float(v), 4)
-                except (ValueError, TypeError):
-                    return 0.0
-
+        for i in totals.day_indices():
             item = {
-                "date": day.isoformat(),
-                "steps": _int(metrics.get("steps", 0)),
-                "flights": _int(metrics.get("flights", 0)),
-                "distance": _dec(metrics.get("distance", 0)),
-                "active": _dec(metrics.get("calories", 0)),
-                "basal": _dec(metrics.get("basal_calories", 0)),
-                "exercise": _dec(metrics.get("exercise", 0)),
+                "date": totals.day(i).isoformat(),
+                "steps": _round_int(series["steps"][i]),
+                "flights": _round_int(series["flights"][i]),
+                "distance": _round_dec(series["distance"][i]),
+                "active": _round_dec(series["calories"][i]),
+                "basal": _round_dec(series["basal_calories"][i]),
+                "exercise": _round_dec(series["exercise"][i]),
             }
             if export_date_str:
                 item["exportDate"] = export_date_str
@@ -455,11 +398,7 @@ def export_excel(jwt_token=None):
             payload_builder=lambda chunk: {"summaries": chunk},
         )
 
-        # 3) activity summaries (filtered by date range if possible)
-        act_summaries = []
-        for rec in root.findall(".//ActivitySummary"):
-            attrs = dict(rec.attrib)
-            act_summaries.append(attrs)
+        # 3) activity summaries (collected during the pass above)
         _post_in_batches(
             f"{BACKEND}/api/apple-health/activity-summaries",
             act_summaries,
@@ -476,31 +415,18 @@ def export_excel(jwt_token=None):
 
 def _sigint_handler(_signum, _frame):
     CANCEL_EVENT.set()
+    # Wake ensure_authenticated, which is blocked on this event
+    AUTH_SUCCESS.set()
 
 
-try:
-    # install Ctrl+C handler
-    try:
-        signal.signal(signal.SIGINT, _sigint_handler)
-    except ValueError:
-        # In some environments signals may not be configurable; ignore
-        pass
+def authenticate_or_exit():
+    """Return a token the backend accepts, or exit.
 
-    token = ensure_authenticated()
-    if CANCEL_EVENT.is_set():
-        print("\nOperation cancelled by user.")
-        sys.exit(1)
-    if not token:
-        print("⚠️ Authentication timed out (5 minutes). Process cancelled.")
-        sys.exit(1)
-    # Validate token with local API before proceeding; if invalid, start OAuth
-    if not validate_token(token):
-        print("⚠️ Stored token invalid. Starting OAuth re-authentication…")
-        try:
-            print("Clearing stored token.")
-            clear_stored_token()
-        except KeyringError:
-            pass
+    Tries $HEALTH_TOKEN, then the keyring token, then a fresh OAuth login,
+    moving on whenever the backend rejects the current one.
+    """
+    while True:
+        from_oauth = not get_stored_token()
         token = ensure_authenticated()
         if CANCEL_EVENT.is_set():
             print("\nOperation cancelled by user.")
@@ -508,19 +434,43 @@ try:
         if not token:
             print("⚠️ Authentication timed out (5 minutes). Process cancelled.")
             sys.exit(1)
-        if not validate_token(token):
+        # Validate token with local API before proceeding
+        if validate_token(token):
+            return token
+        if from_oauth:
             print("❌ Authentication failed: token invalid after re-authentication.")
             sys.exit(1)
-    export_excel(token)
-except ValueError:
-    print("❌ Dates must be in YYYY-MM-DD format")
-    sys.exit(1)
-except KeyboardInterrupt:
-    # Ensure server is shut down if running and exit cleanly
-    if SERVER_STATE["instance"] is not None:
         try:
-            SERVER_STATE["instance"].shutdown()
-        except OSError:
+            print("⚠️ Stored token invalid. Clearing stored token.")
+            clear_stored_token()
+        except KeyringError:
             pass
-    print("\nOperation cancelled by user.")
-    sys.exit(1)
+        if get_stored_token():
+            print("Trying the token stored in the keyring…")
+        else:
+            print("Starting OAuth re-authentication…")
+
+
+def main():
+    """Authenticate, then post the whole export to the backend."""
+    try:
+        # install Ctrl+C handler
+        try:
+            signal.signal(signal.SIGINT, _sigint_handler)
+        except ValueError:
+            # In some environments signals may not be configurable; ignore
+            pass
+
+        token = authenticate_or_exit()
+        export_excel(token)
+    except ValueError:
+        print("❌ Dates must be in YYYY-MM-DD format")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # The callback server thread is a daemon; just exit cleanly
+        print("\nOperation cancelled by user.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,8 @@
-import xml.etree.ElementTree as ET
-from datetime import datetime,timezone
+from datetime import datetime,timezone,timedelta
+from apple_health_agg import iter_elements
 
 # Path to export.xml
-tree = ET.parse('export.xml')
-root = tree.getroot()
+FILE = 'export.xml'
 
 # Period to sum
 start = datetime(2025, 6, 30, tzinfo=timezone.utc)
@@ -16,13 +15,39 @@ types = {
     'HKQuantityTypeIdentifierActiveEnergyBurned': 0
 }
 
-for record in root.findall('Record'):
-    rtype = record.attrib['type']
-    if rtype in types:
-        dt = datetime.fromisoformat(record.attrib['startDate'].replace(' +0100', '+01:00'))
-        if start <= dt <= end:
-            types[rtype] += float(record.attrib['value'])
 
-print("Steps:", round(types['HKQuantityTypeIdentifierStepCount'], 2))
-print("Distance (km):", round(types['HKQuantityTypeIdentifierDistanceWalkingRunning'], 2))
-print("Active Calories (kcal):", round(types['HKQuantityTypeIdentifierActiveEnergyBurned'], 2))
+def sum_period(start, end, types, xml_path=FILE):
+    """Sum the values of each record type in `types` between `start` and `end`.
+
+    Returns a new {type: total} dict; `types` itself is left untouched, so
+    the same mapping can be reused for several periods.
+    """
+    totals = dict.fromkeys(types, 0)
+    # "YYYY-MM-DD" bounds with a day of slack for the UTC offset, so most
+    # out-of-period records are skipped with a string compare
+    start_day = (start - timedelta(days=1)).date().isoformat()
+    end_day = (end + timedelta(days=1)).date().isoformat()
+
+    # Only the root's own Records, not those nested in a Correlation
+    for record in iter_elements(xml_path, nested=False):
+        rtype = record.get('type')
+        if rtype in totals:
+            startdate = record.get('startDate')
+            if not start_day <= startdate[:10] <= end_day:
+                continue
+            # Explicit layout: fromisoformat only accepts " +0100" from 3.11 on
+            dt = datetime.strptime(startdate, '%Y-%m-%d %H:%M:%S %z')
+            if start <= dt <= end:
+                totals[rtype] += float(record.get('value'))
+    return totals
+
+
+def main():
+    totals = sum_period(start, end, types)
+    print("Steps:", round(totals['HKQuantityTypeIdentifierStepCount'], 2))
+    print("Distance (km):", round(totals['HKQuantityTypeIdentifierDistanceWalkingRunning'], 2))
+    print("Active Calories (kcal):", round(totals['HKQuantityTypeIdentifierActiveEnergyBurned'], 2))
+
+
+if __name__ == "__main__":
+    main()
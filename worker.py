@@ -7,14 +7,13 @@ import os
 import time
 import json
 import shutil
+import traceback
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from datetime import datetime
-from collections import defaultdict
-import urllib.request as urlrequest
-import urllib.error as urlerror
+import http.client
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from apple_health_agg import ET, DailyTotals, JsonPoster, iter_elements
 
 # Environment configuration
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:7384")
@@ -32,6 +31,23 @@ PROCESSED_DIR = Path(
     )
 )
 
+# HealthKit record types summed per day, and their summary keys
+AGGREGATE_MAP = {
+    "HKQuantityTypeIdentifierStepCount": "steps",
+    "HKQuantityTypeIdentifierDistanceWalkingRunning": "distance",
+    "HKQuantityTypeIdentifierActiveEnergyBurned": "calories",
+    "HKQuantityTypeIdentifierBasalEnergyBurned": "basal_calories",
+    "HKQuantityTypeIdentifierFlightsClimbed": "flights",
+    "HKQuantityTypeIdentifierAppleExerciseTime": "exercise",
+}
+# Record types whose first value is reported in the user info
+BODY_ATTRS = {
+    "HKQuantityTypeIdentifierBodyMass": "weightInKilograms",
+    "HKQuantityTypeIdentifierHeight": "heightInCentimeters",
+}
+# Elements read from the export; everything else is skipped while parsing
+ELEMENT_TAGS = ("Me", "ExportDate", "Record", "ActivitySummary")
+
 # Ensure directories exist
 WATCH_DIR.mkdir(parents=True, exist_ok=True)
 PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
@@ -42,35 +58,21 @@ class HealthDataProcessor:
 
     def __init__(self, backend_url: str):
         self.backend_url = backend_url
+        # Kept-alive backend connection, reused by every POST
+        self._poster = JsonPoster(timeout=30)
 
     def _post_json(self, endpoint: str, payload: dict, token: str) -> bool:
         """Post JSON data to backend with JWT token."""
         try:
-            url = f"{self.backend_url}{endpoint}"
-            data = json.dumps(payload).encode("utf-8")
-            req = urlrequest.Request(
-                url,
-                data=data,
-                headers={
-                    "Accept": "application/json",
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {token}",
-                },
-                method="POST",
-            )
-            with urlrequest.urlopen(req, timeout=30) as resp:
-                status = resp.status
-                print(f"✅ POST {endpoint} → {status}")
-                return 200 <= status < 300
-        except urlerror.HTTPError as e:
-            print(f"❌ POST {endpoint} failed: HTTP {e.code} - {e.reason}")
-            return False
-        except urlerror.URLError as e:
-            print(f"❌ POST {endpoint} failed: {e.reason}")
-            return False
-        except (ValueError, TypeError, OSError) as e:
+            resp = self._poster.post(f"{self.backend_url}{endpoint}", payload, token)
+        except (http.client.HTTPException, OSError, ValueError, TypeError) as e:
             print(f"❌ POST {endpoint} failed: {e}")
             return False
+        if not 200 <= resp.status < 300:
+            print(f"❌ POST {endpoint} failed: HTTP {resp.status} - {resp.reason}")
+            return False
+        print(f"✅ POST {endpoint} → {resp.status}")
+        return True
 
     def _post_in_batches(
         self,
@@ -106,7 +108,6 @@ class HealthDataProcessor:
                 print(f"❌ Failed to post batch {start}-{end}/{total}")
                 return False
             print(f"✅ Posted batch {start+1}-{end}/{total}")
-            time.sleep(0.1)  # Small delay between batches
 
         return True
 
@@ -117,38 +118,21 @@ class HealthDataProcessor:
             print(f"📝 Processing {xml_path.name}...")
             print(f"{'='*60}")
 
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-
-            # Extract metadata
-            me_elem = root.find(".//Me")
-            me_attrs = me_elem.attrib if me_elem is not None else {}
-            weight = root.find(".//Record[@type='HKQuantityTypeIdentifierBodyMass']")
-            height = root.find(".//Record[@type='HKQuantityTypeIdentifierHeight']")
-            if weight is not None:
-                me_attrs["weightInKilograms"] = weight.attrib.get("value")
-            if height is not None:
-                me_attrs["heightInCentimeters"] = height.attrib.get("value")
-
-            # Extract export date
-            export_date = self._get_export_date(root)
-            print(f"📅 Export Date: {export_date}")
-
-            # Aggregate daily data
+            # One streaming pass collects everything that gets posted
             print("🔄 Aggregating daily data...")
-            daily_data = self._aggregate_daily(root)
-            print(f"📊 Found {len(daily_data)} days of data")
+            me_attrs, export_date, totals, activity_summaries = self._scan_export(
+                xml_path
+            )
+            print(f"📅 Export Date: {export_date}")
+            print(f"📊 Found {len(totals.day_indices())} days of data")
 
             # Post daily summaries
             print("\n📈 Posting daily summaries...")
-            summaries = self._build_summaries(daily_data, export_date)
+            summaries = self._build_summaries(totals, export_date)
             self._post_in_batches("/api/apple-health/daily-summaries", summaries, token)
 
             # Post activity summaries
             print("\n🏃 Posting activity summaries...")
-            activity_summaries = [
-                dict(rec.attrib) for rec in root.findall(".//ActivitySummary")
-            ]
             if activity_summaries:
                 self._post_in_batches(
                     "/api/apple-health/activity-summaries",
@@ -174,68 +158,71 @@ class HealthDataProcessor:
             return False
         except (OSError, IOError, AttributeError, KeyError, ValueError) as e:
             print(f"❌ Error processing {xml_path.name}: {e}")
-            import traceback
-
             traceback.print_exc()
             return False
 
-    def _get_export_date(self, root) -> str:
-        """Extract export date from XML."""
+    def _scan_export(self, xml_path: Path):
+        """Read the export in a single streaming pass.
+
+        Returns (me_attrs, export_date, totals, activity_summaries); the
+        first BodyMass/Height records fill in me_attrs' weight and height.
+        """
+        me_attrs = None
+        export_value = None
+        body = {}  # first value seen for each BodyMass / Height type
+        activity_summaries = []
+        # One float column per metric, grown to cover every record date
+        totals = DailyTotals(AGGREGATE_MAP)
+
+        for elem in iter_elements(xml_path, tags=ELEMENT_TAGS):
+            tag = elem.tag
+            if tag == "Record":
+                dtype = elem.get("type")
+                if dtype in BODY_ATTRS and dtype not in body:
+                    body[dtype] = elem.get("value")
+                totals.add(elem)
+            elif tag == "ActivitySummary":
+                activity_summaries.append(dict(elem.attrib))
+            elif tag == "Me" and me_attrs is None:
+                me_attrs = dict(elem.attrib)
+            elif tag == "ExportDate" and export_value is None:
+                export_value = elem.get("value") or elem.get("date") or elem.text or ""
+
+        me_attrs = me_attrs if me_attrs is not None else {}
+        for dtype, attr in BODY_ATTRS.items():
+            if dtype in body:
+                me_attrs[attr] = body[dtype]
+        export_date = self._get_export_date(export_value)
+        return me_attrs, export_date, totals, activity_summaries
+
+    def _get_export_date(self, val) -> str:
+        """Extract export date from the ExportDate value (None if missing)."""
         try:
-            elem = root.find(".//ExportDate")
-            if elem is None:
-                return datetime.now().strftime("%Y-%m-%d")
-
-            val = elem.attrib.get("value") or elem.attrib.get("date") or elem.text
             if val and "T" in val:
                 val = val.split("T")[0]
-            return val[:10] if val else datetime.now().strftime("%Y-%m-%d")
+            if val:
+                return val[:10]
         except (AttributeError, KeyError, TypeError):
-            return datetime.now().strftime("%Y-%m-%d")
-
-    def _aggregate_daily(self, root):
-        """Aggregate health records by day."""
-        aggregate_map = {
-            "HKQuantityTypeIdentifierStepCount": "steps",
-            "HKQuantityTypeIdentifierDistanceWalkingRunning": "distance",
-            "HKQuantityTypeIdentifierActiveEnergyBurned": "calories",
-            "HKQuantityTypeIdentifierBasalEnergyBurned": "basal_calories",
-            "HKQuantityTypeIdentifierFlightsClimbed": "flights",
-            "HKQuantityTypeIdentifierAppleExerciseTime": "exercise",
-        }
-
-        daily_data = defaultdict(lambda: {k: 0 for k in aggregate_map.values()})
-
-        for record in root.findall(".//Record"):
-            dtype = record.attrib.get("type")
-            if dtype not in aggregate_map:
-                continue
-
-            try:
-                startdate = record.attrib.get("startDate")
-                dt = datetime.fromisoformat(startdate.replace(" +", "+"))
-                value = float(record.attrib.get("value", "0"))
-
-                day_key = dt.date()
-                key = aggregate_map[dtype]
-                daily_data[day_key][key] += value
-            except (ValueError, TypeError):
-                continue
-
-        return daily_data
-
-    def _build_summaries(self, daily_data, export_date):
+            pass
+        # Missing or unusable: fall back to today, formatted only here
+        return datetime.now().strftime("%Y-%m-%d")
+
+    def _build_summaries(self, totals, export_date):
         """Build summary objects for API."""
+        series = totals.series()
+        steps, flights = series["steps"], series["flights"]
+        distance, calories = series["distance"], series["calories"]
+        basal, exercise = series["basal_calories"], series["exercise"]
         summaries = []
-        for day, metrics in sorted(daily_data.items()):
+        for i in totals.day_indices():
             item = {
-                "date": day.isoformat(),
-                "steps": int(round(metrics.get("steps", 0))),
-                "flights": int(round(metrics.get("flights", 0))),
-                "distance": round(metrics.get("distance", 0), 4),
-                "active": round(metrics.get("calories", 0), 4),
-                "basal": round(metrics.get("basal_calories", 0), 4),
-                "exercise": round(metrics.get("exercise", 0), 4),
+                "date": totals.day(i).isoformat(),
+                "steps": int(round(steps[i])),
+                "flights": int(round(flights[i])),
+                "distance": round(distance[i], 4),
+                "active": round(calories[i], 4),
+                "basal": round(basal[i], 4),
+                "exercise": round(exercise[i], 4),
                 "exportDate": export_date,
             }
             summaries.append(item)
@@ -307,8 +294,6 @@ class HealthFileHandler(FileSystemEventHandler):
             print(f"❌ Invalid JSON in job file {job_file}: {e}")
         except (OSError, IOError, KeyError, ValueError, FileNotFoundError) as e:
             print(f"❌ Error processing job {job_file}: {e}")
-            import traceback
-
             traceback.print_exc()
         finally:
             self.processing.discard(str(job_file))